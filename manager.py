@@ -2,21 +2,113 @@ import sqlite3
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-import pandas as pd
+import orjson
 import requests
+import requests_cache
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
-load_dotenv()
+# Set by init()
+conn = None
+cursor = None
+session = None
 
-# Load DB path from environment or default to local file
-db_path = os.getenv("P1_LIST_PATH")
-if not db_path:
-    raise ValueError("P1_LIST_PATH is not set in the environment")
 
+# Open the database and the VATSIM API session. Nothing touches the disk until this is called.
+def init():
+    global conn, cursor, session
 
-# Connect to the database (creates it if it doesn't exist)
-conn = sqlite3.connect(db_path)
-cursor = conn.cursor()
+    load_dotenv()
+
+    # Load DB path from environment or default to local file
+    db_path = os.getenv("P1_LIST_PATH")
+    if not db_path:
+        raise ValueError("P1_LIST_PATH is not set in the environment")
+
+    # Connect to the database (creates it if it doesn't exist)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    # WAL journal with NORMAL sync needs fewer fsyncs per commit and lets readers run alongside the writer
+    cursor.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;
+    """)
+
+    # Indexes for the per-CID UPDATE/DELETE statements and the activity checker's start date lookup
+    # idx_list_cid is not unique as older syncs could insert the same cid twice from a repeated update.csv row
+    cursor.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_list_cid ON LIST(cid);
+        CREATE INDEX IF NOT EXISTS idx_list_check ON LIST(three_month_check_start_date);
+    """)
+
+    # One session is reused so connections are kept alive between calls.
+    # Successful responses are cached next to the database for 30 mins so reruns don't use up the rate limit.
+    session = requests_cache.CachedSession(
+        os.path.join(os.path.dirname(db_path), '.vatsim_cache'),
+        backend='sqlite',
+        expire_after=1800,
+        allowable_codes=(200,),
+    )
+    session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+
+# Token bucket shared by all API workers so the combined request rate stays within the limit
+class TokenBucket:
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # Tokens per second
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    # Block until a token is available, then take it
+    def acquire(self):
+        with self.condition:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.condition.wait((1 - self.tokens) / self.refill_rate)
+
+
+# VATSIM API allows 10 requests/min. A capacity of 1 spaces requests 6 secs apart so no 60 sec window goes over.
+bucket = TokenBucket(capacity=1, refill_rate=1 / 6)
+headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip'}
+
+
+# Rate limited GET against the VATSIM API. Cached responses don't use a token.
+# Transient failures are retried with backoff here rather than in the adapter so every attempt takes a token.
+# Raises once retries run out so the CID is skipped and its hours stay NULL for the next run.
+def fetch(url, retries=3):
+    response = session.get(url, headers=headers, only_if_cached=True)
+    if response.from_cache and response.status_code == 200:
+        return response
+
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            response = session.get(url, headers=headers, timeout=10)
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+        else:
+            if response.status_code not in (429, 500, 502, 503, 504):
+                return response
+            if attempt == retries:
+                response.raise_for_status()
+        time.sleep(0.3 * 2 ** attempt)
 
 
 # Update loop
@@ -32,164 +124,226 @@ def update_db():
 
 # Sync DB with latest update.csv file
 def data_sync():
-    new_data = pd.read_csv('Data\\update.csv')
+    import pandas as pd
+
+    # Only cid and join_date are used. Reading them as strings skips type inference on every column.
+    new_data = pd.read_csv(os.path.join('Data', 'update.csv'), usecols=['cid', 'join_date'], dtype={'cid': 'string', 'join_date': 'string'})
     current_data = pd.read_sql_query('SELECT cid FROM LIST', conn)
 
     # Normalize cid columns to ensure accurate comparison
-    new_data['cid'] = new_data['cid'].astype(str).str.strip()
+    new_data['cid'] = new_data['cid'].str.strip()
     current_data['cid'] = current_data['cid'].astype(str).str.strip()
 
-    # 1. Find rows in new_data that are not in current_data (to add)
-    to_add = new_data[~new_data['cid'].isin(current_data['cid'])]
-
-    # 2. Find rows in current_data that are not in new_data (to remove)
-    to_remove = current_data[~current_data['cid'].isin(new_data['cid'])]
-
-    # 3. Print and execute deletions
+    # Rows without a cid can't be synced
+    missing_cid = new_data['cid'].fillna('') == ''
+    if missing_cid.any():
+        print(f"Skipping {missing_cid.sum()} row(s) in update.csv with no cid.")
+        new_data = new_data[~missing_cid]
+
+    new_ids = set(new_data['cid'])
+    cur_ids = set(current_data['cid'])
+
+    # 1. Find CIDs in new_data that are not in current_data (to add). Kept in update.csv order.
+    # If a cid is repeated the first join date is kept.
+    # Blank join dates are read as pd.NA, which sqlite can't bind, so store them as NULL.
+    join_dates = {}
+    duplicate_cids = []
+    for cid, join_date in zip(new_data['cid'], new_data['join_date']):
+        if cid in join_dates:
+            duplicate_cids.append(cid)
+        else:
+            join_dates[cid] = None if pd.isna(join_date) else join_date
+    if duplicate_cids:
+        print(f"Ignoring {len(duplicate_cids)} repeated row(s) in update.csv, keeping the first join date for:")
+        print('\n'.join(dict.fromkeys(duplicate_cids)))
+    inserts = [(cid, join_date) for cid, join_date in join_dates.items() if cid not in cur_ids]
+
+    # 2. Find CIDs in current_data that are not in new_data (to remove)
+    deletes = [(cid,) for cid in current_data['cid'] if cid not in new_ids]
+
+    # 3. Print deletions
     print("The following CIDs will be deleted from the database:")
-    for cid in to_remove['cid']:
+    for (cid,) in deletes:
         print(f" - Deleting cid: {cid}")
-        cursor.execute("DELETE FROM LIST WHERE cid = ?", (cid,))
 
-    # 4. Print and execute additions
+    # 4. Print additions
     print("The following new users will be added to the database:")
-    for _, row in to_add.iterrows():
-        print(f" - Adding cid: {row['cid']}, list_join_date: {row['join_date']}")
-        cursor.execute("""
-            INSERT INTO LIST (cid, list_join_date, pilot_hours, atc_hours, three_month_check_start_date)
-            VALUES (?, ?, NULL, NULL, NULL)
-        """, (row['cid'], row['join_date']))
+    for cid, join_date in inserts:
+        print(f" - Adding cid: {cid}, list_join_date: {join_date}")
 
     # Review
-    print(f"\n{len(to_remove)} user(s) scheduled for deletion.")
-    print(f"{len(to_add)} user(s) scheduled for addition.")
+    print(f"\n{len(deletes)} user(s) scheduled for deletion.")
+    print(f"{len(inserts)} user(s) scheduled for addition.")
 
-    # Commit
-    conn.commit()
+    # Execute and commit in a single transaction
+    with conn:
+        cursor.executemany("DELETE FROM LIST WHERE cid = ?", deletes)
+        cursor.executemany("""
+            INSERT INTO LIST (cid, list_join_date, pilot_hours, atc_hours, three_month_check_start_date)
+            VALUES (?, ?, NULL, NULL, NULL)
+        """, inserts)
     print("Changes committed.")
 
 
 # Make sure there are no NULL hour values
 def update_null_hours():
-    null_hour_cid_df = pd.read_sql_query('SELECT cid FROM LIST WHERE pilot_hours IS NULL OR atc_hours IS NULL', conn)
-    update_hours(null_hour_cid_df)
+    rows = cursor.execute('SELECT cid FROM LIST WHERE pilot_hours IS NULL OR atc_hours IS NULL').fetchall()
+    update_hours([r[0] for r in rows])
 
 
-# Updates a list of hours for a list of CIDs. Input a dataframe with a column named "cid". 7 sec delay ensures you remain below 10 requests/min for VATSIM API.
-def update_hours(cid_df):
-    for index, row in cid_df.iterrows():
-        cid = row['cid']
-        pilot_hours, atc_hours = get_hours(cid, "1995-01-01T00:00:00+00:00", "2100-01-01T00:00:00+00:00")
-        cursor.execute("""
+# Updates all-time hours for a list of CIDs.
+# Rows are committed in batches as results arrive so a crash part way through keeps the hours already fetched.
+def update_hours(cids, batch_size=10):
+    rows = []
+    for cid, pilot_hours, atc_hours in get_hours_concurrently(cids, get_total_hours):
+        rows.append((pilot_hours, atc_hours, cid))
+        if len(rows) >= batch_size:
+            save_hours(rows)
+            rows = []
+    save_hours(rows)
+
+
+def save_hours(rows):
+    with conn:
+        cursor.executemany("""
             UPDATE LIST
             SET pilot_hours = ?, atc_hours = ?
             WHERE cid = ?
-        """, (pilot_hours, atc_hours, cid))
-        conn.commit()
-        time.sleep(7)
-
-
-# VATSIM API call to get hours
+        """, rows)
+
+
+# Run get_cid_hours(cid, *args) for many CIDs at once. Yields (cid, pilot_hours, atc_hours) tuples in input order.
+# The shared token bucket keeps the combined request rate below the VATSIM API limit.
+# A CID whose fetch raises is reported and skipped so the rest of the batch still completes.
+def get_hours_concurrently(cids, get_cid_hours, *args):
+    executor = ThreadPoolExecutor(max_workers=8)
+    try:
+        futures = [executor.submit(get_cid_hours, cid, *args) for cid in cids]
+        for cid, future in zip(cids, futures):
+            try:
+                yield (cid, *future.result())
+            except Exception as e:
+                print(f"Failed to fetch hours for cid {cid}: {e}")
+    finally:
+        # If the caller stops early (error, Ctrl+C) don't keep spending API requests on queued CIDs
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# VATSIM API calls to get hours within a date range
 def get_hours(cid, start, end):
     pilot_hours = get_pilot_hours(cid, start, end)
-    time.sleep(7)
     atc_hours = get_atc_hours(cid, start, end)
     return round(pilot_hours, 2), round(atc_hours, 2)
-    
 
-def get_pilot_hours(cid, start, end):
-    start_range = datetime.fromisoformat(start)
-    end_range = datetime.fromisoformat(end)
 
-    url = f"https://api.vatsim.net/v2/members/{cid}/history?limit=10000"
-    headers = {'Accept': 'application/json'}
+# VATSIM API call to get all-time hours. The stats endpoint returns pilot and ATC totals in a single call.
+def get_total_hours(cid):
+    url = f"https://api.vatsim.net/v2/members/{cid}/stats"
 
-    response = requests.get(url, headers=headers)
+    response = fetch(url)
 
     if response.status_code != 200:
-        return 0
+        return 0, 0
 
-    data = response.json()
-    total_seconds = 0
+    data = orjson.loads(response.content)
 
-    for session in data.get('items', []):
-        start_str = session.get('start')
-        end_str = session.get('end')
+    return round(data.get('pilot', 0.0), 2), round(data.get('atc', 0.0), 2)
 
-        if not start_str or not end_str:
-            continue
 
-        start = datetime.fromisoformat(start_str.replace("Z", "+00:00"))
-        end = datetime.fromisoformat(end_str.replace("Z", "+00:00"))
+def get_pilot_hours(cid, start, end):
+    import pandas as pd
+
+    url = f"https://api.vatsim.net/v2/members/{cid}/history?limit=10000"
 
-        if end < start_range or start > end_range:
-            continue
+    response = fetch(url)
+
+    if response.status_code != 200:
+        return 0
 
-        actual_start = max(start, start_range)
-        actual_end = min(end, end_range)
-        total_seconds += (actual_end - actual_start).total_seconds()
+    data = orjson.loads(response.content)
+    sessions = pd.DataFrame(data.get('items', []), columns=['start', 'end'])
 
-    return total_seconds / 3600  # Return in hours
+    return sum_session_hours(sessions, start, end)
 
 
 def get_atc_hours(cid, start, end):
-    start_range = datetime.fromisoformat(start)
-    end_range = datetime.fromisoformat(end)
+    import pandas as pd
 
     url = f"https://api.vatsim.net/v2/members/{cid}/atc?limit=10000"
-    headers = {'Accept': 'application/json'}
 
-    response = requests.get(url, headers=headers)
+    response = fetch(url)
 
     if response.status_code != 200:
         return 0
 
-    data = response.json()
-    total_seconds = 0
+    data = orjson.loads(response.content)
 
-    for session in data.get('items', []):
-        conn = session.get('connection_id', {})
-        start_str = conn.get('start')
-        end_str = conn.get('end')
+    # Flatten connection_id.start/end into columns
+    sessions = pd.json_normalize(data.get('items', []), sep='_')
+    sessions = sessions.reindex(columns=['connection_id_start', 'connection_id_end'])
+    sessions.columns = ['start', 'end']
 
-        if not start_str or not end_str:
-            continue
+    return sum_session_hours(sessions, start, end)
 
-        start_dt = datetime.fromisoformat(start_str.replace("Z", "+00:00"))
-        end_dt = datetime.fromisoformat(end_str.replace("Z", "+00:00"))
 
-        if end_dt < start_range or start_dt > end_range:
-            continue
+# Total hours of the sessions (dataframe with "start" and "end" ISO strings) that fall within the date range
+def sum_session_hours(sessions, start, end):
+    import pandas as pd
 
-        actual_start = max(start_dt, start_range)
-        actual_end = min(end_dt, end_range)
-        total_seconds += (actual_end - actual_start).total_seconds()
+    start_range = pd.Timestamp(datetime.fromisoformat(start))
+    end_range = pd.Timestamp(datetime.fromisoformat(end))
 
-    return total_seconds / 3600  # Return in hours
-    
+    # Skip sessions with a missing start or end
+    sessions = sessions.dropna(subset=['start', 'end'])
+    sessions = sessions[(sessions['start'] != '') & (sessions['end'] != '')]
+    if sessions.empty:
+        return 0
 
-# Change the null 3 month checker start dates to the first of the next month
-def update_null_check_start_dates():
-    cursor.execute("""
-        SELECT cid, list_join_date
-        FROM LIST
-        WHERE three_month_check_start_date IS NULL
-    """)
+    session_start = pd.to_datetime(sessions['start'], utc=True, format='ISO8601')
+    session_end = pd.to_datetime(sessions['end'], utc=True, format='ISO8601')
 
-    rows = cursor.fetchall()
+    # Skip sessions entirely outside the range and clip the rest to it
+    in_range = (session_end >= start_range) & (session_start <= end_range)
+    clipped = (session_end.clip(upper=end_range) - session_start.clip(lower=start_range))[in_range]
 
-    for cid, join_date_str in rows:
-        join_date = datetime.strptime(join_date_str, '%d/%m/%Y %H:%M:%S')  # Adjust format if needed
-        first_of_next_month = (join_date.replace(day=1) + timedelta(days=32)).replace(day=1)
-        date_str = first_of_next_month.strftime('%Y-%m-%d')
+    return clipped.sum().total_seconds() / 3600  # Return in hours
+    
 
+# Change the null 3 month checker start dates to the first of the next month
+def update_null_check_start_dates():
+    # list_join_date is stored as dd/mm/YYYY HH:MM:SS. Adjust the substr offsets if the format changes.
+    with conn:
         cursor.execute("""
             UPDATE LIST
-            SET three_month_check_start_date = ?
-            WHERE cid = ?
-        """, (date_str, cid))
-
-    conn.commit()
+            SET three_month_check_start_date = date(substr(list_join_date, 7, 4) || '-' || substr(list_join_date, 4, 2) || '-01', '+1 month')
+            WHERE three_month_check_start_date IS NULL
+        """)
+
+        # Join dates without zero padding don't fit the offsets above, so parse any that are left in one pass
+        rows = cursor.execute("""
+            SELECT cid, list_join_date
+            FROM LIST
+            WHERE three_month_check_start_date IS NULL
+        """).fetchall()
+
+        # Members with no join date can't be given a start date, so they won't be activity checked until one is set
+        missing_join_date = [cid for cid, join_date in rows if join_date is None]
+        if missing_join_date:
+            print(f"{len(missing_join_date)} user(s) have no list_join_date and no 3-month check start date:")
+            print('\n'.join(missing_join_date))
+        rows = [row for row in rows if row[1] is not None]
+
+        if rows:
+            import pandas as pd
+
+            cids, join_dates = zip(*rows)
+            parsed = pd.to_datetime(pd.Series(join_dates), format='%d/%m/%Y %H:%M:%S', cache=True)
+            first_of_next_month = (parsed + pd.offsets.MonthBegin(1)).dt.strftime('%Y-%m-%d')
+            cursor.executemany("""
+                UPDATE LIST
+                SET three_month_check_start_date = ?
+                WHERE cid = ?
+            """, zip(first_of_next_month, cids))
 
 
 # Validate minimum hours
@@ -212,11 +366,9 @@ def minimum_hours_checker():
         );
     """
 
-    # Load result into DataFrame
-    violators_df = pd.read_sql_query(query, conn)
-
     # Get the list of violating CIDs
-    violating_cids = violators_df['cid'].tolist()
+    rows = cursor.execute(query).fetchall()
+    violating_cids = [r[0] for r in rows]
 
     print("\n\n========= Minimum hour checks =========")
     print("CIDs which do NOT meet the minimum hour requirements:")
@@ -249,39 +401,50 @@ def activity_checker():
     WHERE three_month_check_start_date = ?
     """
 
-    df = pd.read_sql_query(query, conn, params=(target_str,))[['cid', 'pilot_hours']]
-    df['active'] = False
+    prev_hours = dict(cursor.execute(query, (target_str,)).fetchall())
+    first_of_month = today.replace(day=1).strftime('%Y-%m-%d')
 
     print("\n\n========= Activity checks =========")
-    for index, row in df.iterrows():
-        cid = row.iloc[0]
-        pilot_hours, atc_hours = get_hours(cid,target_str_full, prev_day_str_full)
-
-        # Meets requirements
-        if float(pilot_hours) - float(row.iloc[1]) >= 10:
-            df.loc[df['cid'] == cid, 'active'] = True
-            first_of_month = datetime.today().replace(day=1).strftime('%Y-%m-%d')
-            cursor.execute("""
-                UPDATE LIST
-                SET pilot_hours = ?, atc_hours = ?, three_month_check_start_date = ?
-                WHERE cid = ?
-            """, (pilot_hours, atc_hours, first_of_month, cid))
-            conn.commit()
-
-        time.sleep(7) # prevent timeout
+    active_cids = []
+    inactive_cids = []
+    active_rows = []
+    for cid, pilot_hours, atc_hours in get_hours_concurrently(list(prev_hours), get_hours, target_str_full, prev_day_str_full):
+        # Meets requirements. NULL previous hours never meet them, as with the old NaN comparison.
+        if prev_hours[cid] is not None and float(pilot_hours) - float(prev_hours[cid]) >= 10:
+            active_cids.append(cid)
+            active_rows.append((pilot_hours, atc_hours, first_of_month, cid))
+        else:
+            inactive_cids.append(cid)
+
+    # CIDs that failed to fetch keep their check start date untouched
+    checked_cids = set(active_cids) | set(inactive_cids)
+    unchecked_cids = [cid for cid in prev_hours if cid not in checked_cids]
+
+    with conn:
+        cursor.executemany("""
+            UPDATE LIST
+            SET pilot_hours = ?, atc_hours = ?, three_month_check_start_date = ?
+            WHERE cid = ?
+        """, active_rows)
 
-    print(f"Hours for {len(df[df['active'] == True])} active user(s) updated:")
-    print('\n'.join(df[df['active'] == True]['cid'].tolist()))
-    print(f"\n{len(df[df['active'] == False])} inactive user(s) found:")
-    print('\n'.join(df[df['active'] == False]['cid'].tolist()))
+    print(f"Hours for {len(active_cids)} active user(s) updated:")
+    print('\n'.join(active_cids))
+    print(f"\n{len(inactive_cids)} inactive user(s) found:")
+    print('\n'.join(inactive_cids))
+    if unchecked_cids:
+        print(f"\n{len(unchecked_cids)} user(s) could not be checked:")
+        print('\n'.join(unchecked_cids))
 
-        
 
+def main():
+    init()
+    update_db()
+    minimum_hours_checker()
+    activity_checker()
 
-update_db()
-minimum_hours_checker()
-activity_checker()
+    # Close connection
+    conn.close()
 
 
-# Close connection
-conn.close()
+if __name__ == "__main__":
+    main()